@@ -129,10 +129,27 @@ example of functional composition:
 import pandas as pd
 import numpy as np
 import requests
+import io
+import csv
+import os
 import itertools
+import multiprocessing
 import re
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import matplotlib.pyplot as plt
 
+# Numba is optional: used to JIT-compile the scoring kernel if installed
+try:
+    from numba import njit, prange, set_num_threads
+except ImportError:
+    njit = None
+
+# Number of random rankings scored at once in _count_random()
+_BATCH_SIZE = 64
+# Separator of gene symbols in the cellmarker database (special characters)
+_WORD_SPLIT = re.compile(r'\W+')
+
 
 # WRANGLE & PARSE REF #############
 
@@ -153,23 +170,38 @@ def wrangle_ranked_genes(anndata):
     nb_marker = len(anndata.uns['rank_genes_groups']['names'])
     print('Wrangling: Number of markers used in ranked_gene_groups: ', nb_marker)
     print('Wrangling: Groups used for ranking:', anndata.uns['rank_genes_groups']['params']['groupby'])
-    # Wrangle results into a table (pandas dataframe)
-    top_score = pd.DataFrame(anndata.uns['rank_genes_groups']['scores']).loc[:nb_marker]
-    top_adjpval = pd.DataFrame(anndata.uns['rank_genes_groups']['pvals_adj']).loc[:nb_marker]
-    top_gene = pd.DataFrame(anndata.uns['rank_genes_groups']['names']).loc[:nb_marker]
-    marker_df = pd.DataFrame()
+    # Wrangle results into a table (pandas dataframe), reading each cluster field of the structured arrays
+    top_score = anndata.uns['rank_genes_groups']['scores']
+    top_adjpval = anndata.uns['rank_genes_groups']['pvals_adj']
+    top_gene = anndata.uns['rank_genes_groups']['names']
+    frames = []
     # Order values
-    for i in range(len(top_score.columns)):
-        concat = pd.concat([top_score[[str(i)]], top_adjpval[str(i)], top_gene[[str(i)]]], axis=1, ignore_index=True)
-        concat['cluster_number'] = i
-        col = list(concat.columns)
-        col[0], col[1], col[-2] = 'z_score', 'adj_pvals', 'gene'
-        concat.columns = col
-        marker_df = marker_df.append(concat)
+    for i in range(len(top_gene.dtype.names)):
+        frames.append(pd.DataFrame({'z_score': top_score[str(i)],
+                                    'adj_pvals': top_adjpval[str(i)],
+                                    'gene': top_gene[str(i)],
+                                    'cluster_number': i}))
+    marker_df = pd.concat(frames, ignore_index=True)
 
     return marker_df
 
 
+def _ranked_gene_names(anndata):
+    """
+    Get the gene ranking of the ranked_genes_groups function of Scanpy as a matrix of gene names.
+
+    Args:
+        anndata (Anndata object): object from Scanpy analysis.
+
+    Return:
+        gene_names (np.array): top N ranked genes (clusters X N), ordered by rank.
+    """
+
+    top_gene = anndata.uns['rank_genes_groups']['names']
+
+    return np.array([top_gene[str(i)] for i in range(len(top_gene.dtype.names))])
+
+
 def _parse_ref(path, species, organ, context=None, comments=False):
     """
     Parses the ref file of specified species into relevant information specified by user.
@@ -240,28 +272,20 @@ def use_cellmarkerdb(species, tissue):
     """
 
     req = requests.get("http://biocc.hrbmu.edu.cn/CellMarker/download/all_cell_markers.txt")
-    parsed_file = []
-    for chunk in req.iter_lines():
-        chunk = chunk.decode("utf-8").split('\t')
-        parsed_file.append(chunk)
-
-    marker_df = pd.DataFrame(columns=parsed_file[0], data=parsed_file[1:])
+    # Parse UTF-8 bytes with the C parser of pandas, without quoting (fields are only tab separated) and keeping
+    # empty fields as strings. Category dtypes for fields used to subset.
+    marker_df = pd.read_csv(io.BytesIO(req.content), sep='\t', encoding='utf-8', quoting=csv.QUOTE_NONE,
+                            keep_default_na=False,
+                            dtype={'speciesType': 'category', 'tissueType': 'category', 'cellName': 'category'})
 
     # Subset for interesting information
     sub_df = marker_df[marker_df['speciesType'] == species]
     sub_df = sub_df[sub_df['tissueType'] == tissue]
 
     # Parse information to create new reference
-    list_ct = sub_df['cellName'].unique().tolist()
-    # Use re to remove special characters
-    dict_marker = {
-        ct: [re.split('\W+', gene) for gene in sub_df[sub_df['cellName'] == ct]['geneSymbol'].unique().tolist()]
-        for ct in list_ct}
-
-    # merge nested lists without spelling strings
-    for ct in dict_marker.keys():
-        dict_marker[ct] = list(
-            itertools.chain.from_iterable(itertools.repeat(x, 1) if isinstance(x, str) else x for x in dict_marker[ct]))
+    # Use re to remove special characters, split all gene symbols at once and get one gene per row
+    exploded = sub_df.assign(gene=sub_df['geneSymbol'].str.split(_WORD_SPLIT)).explode('gene')
+    dict_marker = exploded.groupby('cellName', observed=True, sort=False)['gene'].unique().to_dict()
 
     # Use dict to initialize df. Here order in memory doesn't mess with loading.
     ref_df = pd.DataFrame({ct: pd.Series(genes) for ct, genes in dict_marker.items()})
@@ -277,18 +301,14 @@ def _get_genelist(species):
         species (str): Name of the species of interest.
 
     Returns:
-        gene_list (list): List of all genes.
+        gene_list (np.array): Array of all genes.
     """
     # Convert name to lowercase to access
     species = species.lower()
     response = requests.get('http://public.gi.ucsc.edu/~lseninge/' + species + '_genes.tsv')
-    gene_list = []
-    lines = response.iter_lines()
-    # Skip first line
-    next(lines)
-    for chunk in lines:
-        chunk = chunk.decode("utf-8")
-        gene_list.append(chunk)
+    # Parse in one pass, first line is the header. Keep gene names such as 'NA' as strings.
+    gene_list = pd.read_csv(io.BytesIO(response.content), sep='\t', encoding='utf-8', quoting=csv.QUOTE_NONE,
+                            header=0, usecols=[0], dtype=str, keep_default_na=False).iloc[:, 0].to_numpy()
 
     return gene_list
 
@@ -298,7 +318,7 @@ def _get_genelist(species):
 def score_clusters(anndata, path=None,
                    species='human', organ='brain',
                    context=None, comments=False,
-                   user_ref=None, bin_size=20, random_sampling=1000):
+                   user_ref=None, bin_size=20, random_sampling=1000, n_jobs=1):
     """
     Assign a p-value and a score to each cell type for each cluster in the data.
 
@@ -315,6 +335,9 @@ def score_clusters(anndata, path=None,
         as a dataframe with a list of known markers per curated cell types.
         bin_size (int): size of bins to score.
         random_sampling (int): Number of iterations for re-scoring and stats with random genes. Default to 1000.
+        n_jobs (int): Number of processes for random sampling. -1 uses all cores. Default to 1.
+        Each process starts a new interpreter that imports the calling script: in a script, call score_clusters()
+        under an if __name__ == '__main__': guard. Only worth it for many iterations, Numba already uses all cores.
 
     Return:
         anndata (Anndata object): object from Scanpy analysis updated with .uns slot 'scoreCT':
@@ -326,6 +349,11 @@ def score_clusters(anndata, path=None,
             (eg: 1:{CT_1: 0, CT_2:3} ...})
     """
 
+    if n_jobs == 0 or n_jobs < -1:
+        raise ValueError('n_jobs must be a positive number of processes or -1 for all cores, got ' + str(n_jobs))
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+
     # Check if required are present
     if not (not ('louvain' not in anndata.obs) or not ('leiden' not in anndata.obs)) or 'rank_genes_groups' not in anndata.uns:
         return 'Error: No clustering solution OR gene ranking found. Please perform scanpy.tl.louvain or' \
@@ -334,8 +362,8 @@ def score_clusters(anndata, path=None,
     # Get number of markers from anndata object
     nb_marker = len(anndata.uns['rank_genes_groups']['names'])
     # Get ranking of genes from DGE in scanpy object
-    print('scoreCT: Wrangling gene ranking...')
-    ranked_marker = wrangle_ranked_genes(anndata)
+    print('scoreCT: Reading gene ranking...')
+    ranked_genes = _ranked_gene_names(anndata)
 
     # Use user reference if specified, otherwise get data of specified species/organ/context
     print('scoreCT: Parsing reference...')
@@ -344,132 +372,271 @@ def score_clusters(anndata, path=None,
     else:
         ref_marker = _parse_ref(path=path, species=species, organ=organ, context=context, comments=comments)
 
+    # Map genes to integer ids and build the cell type incidence matrix once for all iterations.
+    ref_sets = _ref_sets(ref_marker)
+    gene_to_idx = _gene_index(ranked_genes.ravel(), ref_sets)
+    ref_mat = _ref_matrix(ref_sets, gene_to_idx)
+    cell_types = list(ref_sets)
+
     # Call _score_iter() method to get initial scores for actual gene ranking.
     print('scoreCT: Computing scores...')
-    ref_score = _score_iter(ranked_marker=ranked_marker,
+    gene_ids = _gene_ids(ranked_genes, gene_to_idx)
+    ref_score = _score_iter(gene_ids=gene_ids,
                             nb_marker=nb_marker,
-                            ref_df=ref_marker,
+                            ref_mat=ref_mat,
                             bin_size=bin_size)
 
     # Iterate for K iterations and get number of time scores are superior to initial scores with random genes.
     # Get list of gene to randomize ranking. human by default. human and mouse available.
     gene_list = _get_genelist(species=species)
 
-    # Empty count dict for stats
-    count_dict = {clust: {ct: 0 for ct in ref_score[clust]} for clust in ref_score.keys()}
-
-    for i in range(random_sampling):
-        # Right now, we randomize on the whole ranked dataframe, with all cluster.
-        # Maybe better to randomize cluster by cluster?
-        i_dict = _score_iter(randomize_genes(ranked_marker, gene_list),
-                             nb_marker=nb_marker,
-                             ref_df=ref_marker,
-                             bin_size=bin_size)
-        # Check for better score in randomized ranking score dict - NAIVE IMPLEMENTATION
-        for clust in ref_score.keys():
-            for ct in ref_score[clust].keys():
-                if i_dict[clust][ct] >= ref_score[clust][ct]:
-                    count_dict[clust][ct] += 1
+    # Background genes as ids, genes absent from ranking and reference point to the empty row of ref_mat
+    bg_ids = _gene_ids(gene_list, gene_to_idx)
+    # Only ranks of full bins are scored: draw random genes for these ranks only, outside of any DataFrame
+    scored_ids = gene_ids[:, :int(nb_marker / bin_size) * bin_size]
+    args = (ref_score, scored_ids, bg_ids, nb_marker, ref_mat, bin_size)
+
+    count = None
+    if n_jobs > 1:
+        # Split iterations between processes, each one with an independent random stream
+        n_iters = [random_sampling // n_jobs + (i < random_sampling % n_jobs) for i in range(n_jobs)]
+        seeds = np.random.SeedSequence().spawn(n_jobs)
+        # Spawn fresh interpreters: forking after Numba threads have started is not safe
+        try:
+            with ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=_init_worker) as executor:
+                count = sum(executor.map(_count_random, n_iters, seeds, *[itertools.repeat(arg) for arg in args]))
+        except BrokenProcessPool:
+            print('scoreCT: Worker processes failed to start (is score_clusters() called under an '
+                  "if __name__ == '__main__': guard?). Running random sampling in a single process...")
+    if count is None:
+        count = _count_random(random_sampling, None, *args)
 
     # Divide by number of iterations
-    stat_dict = {clust: {ct: (float(count) / random_sampling) for ct, count in count_dict[clust].items()
-                         } for clust in count_dict.keys()}
+    stats = count / float(random_sampling)
 
-    # Correct for multiple testing - to debug to avoid 1 * 18 = 18
-    # stat_dict = _correct_pval(stat_dict)
+    # Correct for multiple testing (Benjamini-Hochberg) - not enabled yet, changes the assignment thresholds
+    # stats = _correct_pval(stats)
     print('scoreCT: Saving results to Anndata object...')
-    anndata.uns['scoreCT'] = {'pval_dict':stat_dict, 'score_dict':ref_score,
-                              'clustering':anndata.uns['rank_genes_groups']['params']['groupby']}
+    anndata.uns['scoreCT'] = {'pval_dict': _to_dict(stats, cell_types),
+                              'score_dict': _to_dict(ref_score.astype(int), cell_types),
+                              'clustering': anndata.uns['rank_genes_groups']['params']['groupby']}
 
     return 'DONE'
 
 
-def _score_iter(ranked_marker, nb_marker, ref_df, bin_size):
+def _score_iter(gene_ids, nb_marker, ref_mat, bin_size):
     """
     Get scores for gene ranking of clusters given a reference of cell types/markers.
 
     The gene ranking for cluster i is divided into bins of given size and a score is given for each gene of the
-    reference present in the ranking (score is depending of the bin: linearly scaled).
+    reference present in the ranking (score is depending of the bin: linearly scaled). A gene present several times in
+    a bin (random rankings) is counted once, as in a set intersection.
 
     Args:
-        ranked_marker (pandas.df): A dataframe with ranked markers (from wrangle_ranked_genes()).
+        gene_ids (np.array): gene ids of ranked markers (clusters X nb_marker), ordered by rank (see _gene_ids()).
+        Leading dimensions are kept, eg: (iterations X clusters X nb_marker) for batches of random rankings.
         nb_marker (int): number of top markers retained per cluster.
-        ref_df (pandas.df): Reference dataframe with a cell type per column and a gene per row.
+        ref_mat (np.array): incidence matrix of genes X cell types (see _ref_matrix()).
         bin_size (int): size of bins to score.
 
     Returns:
-        dict_scores (dict): Dictionary with louvain clusters as keys and a dictionary of cell type:score as values.
-        (eg: 1:{CT_1: 0, CT_2:3} ...})
+        scores (np.array): scores for each cluster (rows) and cell type (columns) of the reference, with the
+        leading dimensions of gene_ids.
     """
 
-    # Initialize score dictionary {cluster_1: {cell_type1: X, cell_type2: Y} ...}
-    dict_scores = {}
-    # Scale scores -- linear
-    score_list = range(1, int(nb_marker / bin_size) + 1)
-    # Iterate on clusters
-    for clust in set(ranked_marker['cluster_number']):
-        # Initialize empty dict for given cluster
-        dict_scores[clust] = {}
-        sub_df = ranked_marker[ranked_marker['cluster_number'] == clust]
-        # Get individual bins
-        for k in range(int(nb_marker / bin_size)):
-            bin_df = sub_df[(k * bin_size):bin_size + (k * bin_size)]
-            # Use ref to score
-            # We assume format column = cell types, each row is a different marker
-            for cell_type in list(ref_df):
-                # Get length of intersection between ref marker and bin , multiply by score of the associated bin
-                # score_list[-(1+k)] because k can be 0 for bin purposes
-                score_i = score_list[-(1 + k)] * len(set(ref_df[cell_type]).intersection(set(bin_df['gene'])))
-                # Add score to existing score or create key
-                if cell_type in dict_scores[clust]:
-                    dict_scores[clust][cell_type] += score_i
-                else:
-                    dict_scores[clust][cell_type] = score_i
-
-    return dict_scores
+    # Scale scores -- linear. First bin gets the highest score, genes after the last full bin are not scored.
+    n_bins = int(nb_marker / bin_size)
+    if n_bins == 0:
+        # Less ranked genes than a bin: nothing to score
+        return np.zeros(gene_ids.shape[:-1] + (ref_mat.shape[1],), dtype=ref_mat.dtype)
+    # Count each gene once per bin: sort genes within bins and point repeats to the empty row of ref_mat
+    bins = np.sort(gene_ids[..., :n_bins * bin_size].reshape(gene_ids.shape[:-1] + (n_bins, bin_size)), axis=-1)
+    repeats = bins[..., 1:] == bins[..., :-1]
+    bins[..., 1:][repeats] = ref_mat.shape[0] - 1
+    gene_ids = bins.reshape(gene_ids.shape[:-1] + (n_bins * bin_size,))
+    bin_weights = np.arange(n_bins, 0, -1).astype(ref_mat.dtype)
+    ranked_ids = gene_ids[..., :n_bins * bin_size]
+    if njit is not None:
+        # Fused gather + weighted sum, parallel over rankings, without the incidence tensor
+        weights = np.repeat(bin_weights, bin_size)
+        flat_ids = np.ascontiguousarray(ranked_ids.reshape(-1, ranked_ids.shape[-1]))
+        scores = np.zeros((flat_ids.shape[0], ref_mat.shape[1]), dtype=ref_mat.dtype)
+        _score_kernel(flat_ids, weights, ref_mat, scores)
+        return scores.reshape(ranked_ids.shape[:-1] + (ref_mat.shape[1],))
+
+    # Gather incidence of each ranked gene for all cell types, count markers per bin (... X n_bins X cell types)
+    incidence = ref_mat[ranked_ids].reshape(ranked_ids.shape[:-1] + (n_bins, bin_size, ref_mat.shape[1]))
+    bin_counts = incidence.sum(axis=-2)
+    # Multiply count of each bin by its score and sum over bins
+    scores = np.einsum('k,...kt->...t', bin_weights, bin_counts)
+
+    return scores
+
+
+if njit is not None:
+    @njit(parallel=True, nogil=True, cache=True)
+    def _score_kernel(gene_ids, weights, ref_mat, out):
+        """
+        Numba kernel of _score_iter(): accumulate weighted incidence of ranked genes in out (rankings X cell types).
+        """
+        for c in prange(gene_ids.shape[0]):
+            for b in range(gene_ids.shape[1]):
+                g = gene_ids[c, b]
+                wb = weights[b]
+                for t in range(ref_mat.shape[1]):
+                    out[c, t] += wb * ref_mat[g, t]
+
+
+def _ref_sets(ref_df):
+    """
+    Get the set of markers of each cell type of the reference, built once for all scorings.
+
+    Args:
+        ref_df (pandas.df): Reference dataframe with a cell type per column and a gene per row.
+
+    Returns:
+        ref_sets (dict): cell type as key and set of marker genes as value.
+    """
 
+    return {cell_type: set(ref_df[cell_type].dropna().tolist()) for cell_type in ref_df.columns}
+
+
+def _gene_index(genes, ref_sets):
+    """
+    Map every gene of the ranking and of the reference to an integer id.
+
+    Args:
+        genes (iterable): gene names of the ranked markers.
+        ref_sets (dict): set of marker genes per cell type (see _ref_sets()).
+
+    Returns:
+        gene_to_idx (dict): gene name as key and integer id as value.
+    """
+
+    unique_genes = dict.fromkeys(itertools.chain(genes, *ref_sets.values()))
+
+    return {gene: i for i, gene in enumerate(unique_genes)}
 
-# STATS #############
 
-def randomize_genes(marker_df, gene_list):
+def _ref_matrix(ref_sets, gene_to_idx):
     """
-    Replaces genes in original data by random genes for rescoring.
+    Build the incidence matrix of genes X cell types from the reference.
 
-    TO ADD: MOUSE GENES.
+    The matrix has one extra row of zeros (id len(gene_to_idx)) used for genes absent from the index.
 
     Args:
-        marker_df (pandas.df): gene ranking for louvain clusters in original data.
-        gene_list (list): List of all possible *human* genes.
+        ref_sets (dict): set of marker genes per cell type (see _ref_sets()).
+        gene_to_idx (dict): gene name to integer id (see _gene_index()).
 
     Returns:
-        copy_df (pandas.df): randomized gene ranking for louvain clusters.
+        ref_mat (np.array): 1 if gene is a marker of the cell type, 0 otherwise.
     """
 
-    copy_df = marker_df.copy()
-    # add code here to process cluster by cluster instead of the whole df in one time
-    rd_pick = np.random.choice(gene_list, len(copy_df['gene']))
-    copy_df['gene'] = rd_pick
-    return copy_df
+    ref_mat = np.zeros((len(gene_to_idx) + 1, len(ref_sets)), dtype=np.float32)
+    for ct_idx, markers in enumerate(ref_sets.values()):
+        ref_mat[[gene_to_idx[gene] for gene in markers], ct_idx] = 1
 
+    return ref_mat
+
+
+def _gene_ids(gene_names, gene_to_idx):
+    """
+    Convert an array of gene names to an array of gene ids of the same shape.
+
+    Args:
+        gene_names (np.array): gene names, eg: ranked markers (clusters X nb_marker) from _ranked_gene_names().
+        gene_to_idx (dict): gene name to integer id (see _gene_index()). Unknown genes get the id len(gene_to_idx).
+
+    Returns:
+        gene_ids (np.array): gene ids.
+    """
+
+    gene_ids = np.fromiter((gene_to_idx.get(gene, len(gene_to_idx)) for gene in gene_names.ravel()),
+                           dtype=np.int32, count=gene_names.size)
+
+    return gene_ids.reshape(gene_names.shape)
+
+
+def _init_worker():
+    """
+    Initialize a process of the random sampling pool: one Numba thread per process, cores are used by the pool.
+    """
+    if njit is not None:
+        set_num_threads(1)
+
+
+def _count_random(n_iter, seed, ref_score, scored_ids, bg_ids, nb_marker, ref_mat, bin_size):
+    """
+    Score random rankings and count how many times they score at least as high as the actual gene ranking.
+
+    Args:
+        n_iter (int): number of random rankings to score.
+        seed (np.random.SeedSequence): seed of the random generator. If None, fresh entropy is used.
+        ref_score (np.array): scores of the actual gene ranking (clusters X cell types, see _score_iter()).
+        scored_ids (np.array): gene ids of the scored ranks of the actual gene ranking (clusters X ranks).
+        bg_ids (np.array): gene ids of all possible genes of the species (background).
+        nb_marker (int): number of top markers retained per cluster.
+        ref_mat (np.array): incidence matrix of genes X cell types (see _ref_matrix()).
+        bin_size (int): size of bins to score.
+
+    Returns:
+        count (np.array): number of random scores >= actual scores (clusters X cell types).
+    """
+
+    rng = np.random.default_rng(seed)
+    # Empty count array for stats (clusters X cell types)
+    count = np.zeros(ref_score.shape, dtype=np.int32)
+
+    # Score random rankings by batches of iterations to bound memory of the incidence tensor
+    for start in range(0, n_iter, _BATCH_SIZE):
+        batch = min(_BATCH_SIZE, n_iter - start)
+        # Right now, we randomize all clusters at once: (iterations X clusters X nb_marker)
+        rand_ids = bg_ids[rng.integers(0, len(bg_ids), size=(batch,) + scored_ids.shape, dtype=np.int32)]
+        rand_scores = _score_iter(gene_ids=rand_ids,
+                                  nb_marker=nb_marker,
+                                  ref_mat=ref_mat,
+                                  bin_size=bin_size)
+        # Check for better score in randomized rankings
+        count += (rand_scores >= ref_score[None]).sum(axis=0, dtype=np.int32)
+
+    return count
+
+
+def _to_dict(values, cell_types):
+    """
+    Convert an array of clusters X cell types to nested dictionaries.
+
+    Args:
+        values (np.array): values for each cluster (rows) and cell type (columns).
+        cell_types (list): names of the cell types.
+
+    Returns:
+        dict_values (dict): Dictionary with louvain clusters as keys and a dictionary of cell type:value as values.
+        (eg: 1:{CT_1: 0, CT_2:3} ...})
+    """
+
+    return {clust: dict(zip(cell_types, row)) for clust, row in enumerate(values.tolist())}
+
+
+# STATS #############
 
-def _correct_pval(dict_scores):
+def _correct_pval(pvals):
     """
-    Correct p-values for multiple testing.
+    Correct p-values for multiple testing with the Benjamini-Hochberg procedure (FDR).
 
     Args:
-        dict_scores (dict): dictionary of [scores,p-val] per cluster/cell_types.
+        pvals (np.array): p-values per cluster (rows) and cell type (columns).
 
     Return:
-        dict_scores (dict): input with corrected p-value.
+        qvals (np.array): corrected p-values, same shape as input.
     """
+    from statsmodels.stats.multitest import multipletests
 
-    n_test = len(dict_scores.keys())
-    for clust in dict_scores.keys():
-        for ct in dict_scores[clust].keys():
-            # Multiply by number of cell types
-            dict_scores[clust][ct] *= n_test
+    # All cluster/cell type tests are corrected together
+    _, qvals, _, _ = multipletests(pvals.ravel(), method='fdr_bh')
 
-    return dict_scores
+    return qvals.reshape(pvals.shape)
 
 
 # SUMMARY #############
@@ -530,23 +697,20 @@ def assign_celltypes(anndata, pval_thrsh=0.1):
 
     # Get clustering method used in ranked_genes_groups
     clust_method = anndata.uns['scoreCT']['clustering']
-    # Initialize new metadata column in Anndata object
-    anndata.obs['scorect'] = ''
-    # Iterate on clusters in dict_stats
-    for cluster in anndata.uns['scoreCT']['pval_dict'].keys():
-        # Get cell type with lowest pval
-        # Add pval threshold. Default to pval=0.1
-        min_value = min(anndata.uns['scoreCT']['pval_dict'][cluster].values())
-        if min_value > pval_thrsh:
-            assign_type = 'NA'
-        elif len({key for key, value in anndata.uns['scoreCT']['pval_dict'][cluster].items() if value == min_value}) > 1:
-            # If ties, get best score
-            # Add ties here too ?
-            assign_type = max(anndata.uns['scoreCT']['score_dict'][cluster], key=anndata.uns['scoreCT']['score_dict'][cluster].get)
-        else:
-            assign_type = min(anndata.uns['scoreCT']['pval_dict'][cluster], key=anndata.uns['scoreCT']['pval_dict'][cluster].get)
-        # Update
-        anndata.obs.loc[anndata.obs[clust_method] == str(cluster), 'scorect'] = assign_type
-        anndata.uns['scoreCT']['pval_thrsh'] = pval_thrsh
+    # Tables of clusters X cell types
+    pvals = pd.DataFrame.from_dict(anndata.uns['scoreCT']['pval_dict'], orient='index')
+    scores = pd.DataFrame.from_dict(anndata.uns['scoreCT']['score_dict'], orient='index').loc[pvals.index]
+    # Get cell type with lowest pval. If ties, get best score
+    # Add ties here too ?
+    min_value = pvals.min(axis=1)
+    ties = pvals.eq(min_value, axis=0).sum(axis=1) > 1
+    assign_type = np.where(ties, scores.idxmax(axis=1), pvals.idxmin(axis=1))
+    # Add pval threshold. Default to pval=0.1
+    assign_type = np.where(min_value > pval_thrsh, 'NA', assign_type)
+    # Update new metadata column in Anndata object, as categorical (one code per cell instead of a string)
+    mapping = dict(zip(pvals.index.astype(str), assign_type.tolist()))
+    labels = anndata.obs[clust_method].astype(str).map(mapping).fillna('NA')
+    anndata.obs['scorect'] = pd.Categorical(labels, categories=sorted(set(mapping.values()) | {'NA'}))
+    anndata.uns['scoreCT']['pval_thrsh'] = pval_thrsh
 
     return "Cell types assigned in Anndata.obs['scorect']"